@@ -1,6 +1,5 @@
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 def analyze_excel(file_path):
     """
@@ -10,8 +9,16 @@ def analyze_excel(file_path):
         file_path (str): Path to the Excel file
     """
     try:
+        # Pick the engine from the extension; legacy .xls needs xlrd
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext == '.xls':
+            read_kwargs = {'engine': 'xlrd'}
+        else:
+            read_kwargs = {'engine': 'openpyxl',
+                           'engine_kwargs': {'read_only': True, 'data_only': True}}
+        
         # Read the Excel file with header=None to see raw data
-        df = pd.read_excel(file_path, header=None)
+        df = pd.read_excel(file_path, header=None, **read_kwargs)
         
         # Display the first few rows of raw data
         print("\n=== First 10 rows of data ===")
@@ -22,13 +29,11 @@ def analyze_excel(file_path):
         print(f"Number of rows: {len(df)}")
         print(f"Number of columns: {len(df.columns)}")
         
-        # Display non-null values in each column
+        # Display non-null values in each column, dropping the empty columns in one pass
         print("\n=== Sample of non-null values in each column ===")
-        for col in df.columns:
-            non_null_values = df[col].dropna().unique()
-            if len(non_null_values) > 0:
-                print(f"\nColumn {col}:")
-                print(non_null_values[:5])  # Show first 5 unique non-null values
+        for col, values in df.dropna(axis=1, how='all').items():
+            print(f"\nColumn {col}:")
+            print(values.dropna().unique()[:5])  # Show first 5 unique non-null values
         
         return df
     
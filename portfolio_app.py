@@ -1,46 +1,150 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
 import os
 import glob
+import importlib.util
+import io
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import sqlite3
 import time
-from bs4 import BeautifulSoup
-import yfinance as yf
+from contextlib import closing
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from pandas.api.types import union_categoricals
 
-def load_portfolio_data(file):
-    """Load and process the portfolio data from Excel file."""
+# Excel engine for each supported extension; legacy .xls needs xlrd
+EXCEL_ENGINES = {
+    '.xlsx': 'openpyxl',
+    '.xls': 'xlrd'
+}
+
+# The Rust-based calamine engine reads both .xlsx and .xls roughly twice as fast
+CALAMINE_AVAILABLE = importlib.util.find_spec('python_calamine') is not None
+
+def read_excel_file(file, **kwargs):
+    """Read an Excel file or upload, preferring calamine over the extension's engine."""
+    if CALAMINE_AVAILABLE:
+        try:
+            return pd.read_excel(file, engine='calamine', **kwargs)
+        except Exception:
+            # Fall back to openpyxl/xlrd for workbooks calamine cannot parse
+            if not isinstance(file, str):
+                file.seek(0)
+    
+    name = file if isinstance(file, str) else file.name
+    engine = EXCEL_ENGINES.get(os.path.splitext(name)[1].lower())
+    if engine == 'openpyxl':
+        # Stream rows instead of building the full workbook object model
+        kwargs.setdefault('engine_kwargs', {'read_only': True, 'data_only': True})
+    return pd.read_excel(file, engine=engine, **kwargs)
+
+# Parsed uploads kept for reruns; bounded so old sheets do not stay in server memory
+WORKBOOK_CACHE_MAX_ENTRIES = 32
+WORKBOOK_CACHE_TTL = 3600
+
+@st.cache_data(max_entries=WORKBOOK_CACHE_MAX_ENTRIES, ttl=WORKBOOK_CACHE_TTL, show_spinner=False)
+def read_workbook(file_bytes, filename):
+    """Read an uploaded workbook without headers, cached by its name and content across reruns."""
+    file = io.BytesIO(file_bytes)
+    file.name = filename
+    return read_excel_file(file, header=None)
+
+# Dtypes for the holdings columns, applied once the rows have been cleaned
+HOLDING_DTYPES = {
+    'Company Name': 'category',
+    'ISIN': 'string[pyarrow]',
+    'Scrip Type': 'category',
+    'Balance': 'float64',
+    'Rate (Rs.)': 'float64',
+    'Value (Rs.)': 'float64'
+}
+
+# Person name patterns for filenames and sheet content, tried in order
+# Common patterns: "name demat", "name's demat", etc.
+NAME_PATTERNS = (
+    re.compile(r"^([A-Za-z\s]+)\s+demat", re.IGNORECASE),
+    re.compile(r"^([A-Za-z\s]+)'s\s+demat", re.IGNORECASE),
+    re.compile(r"^([A-Za-z\s]+)\s+portfolio", re.IGNORECASE)
+)
+
+# DP ID label in the statement header, e.g. "DP ID : IN301549"
+DP_ID_PATTERN = re.compile(r"DP ID\s*:\s*(\S+)")
+
+# Rows at the top of the sheet searched for the DP ID and holder name; both sit in the header
+DEMAT_INFO_SCAN_ROWS = 30
+
+# Number of parallel price lookups; kept low to avoid Yahoo Finance rate limiting
+PRICE_FETCH_WORKERS = 3
+
+# How long fetched prices are reused across reruns and restarts, in seconds
+PRICE_CACHE_TTL = 900
+
+# SQLite file holding fetched prices so they survive server restarts
+PRICE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.price_cache.sqlite')
+
+@st.cache_resource
+def get_http_session():
+    """Create a requests session, shared across reruns, whose pool covers all price fetch workers."""
+    session = requests.Session()
+    # Retry connection errors, rate limiting and server errors with exponential backoff,
+    # handing back the last response (rather than raising) once retries run out
+    retries = Retry(
+        total=3,
+        backoff_factor=2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=PRICE_FETCH_WORKERS,
+        pool_maxsize=PRICE_FETCH_WORKERS,
+        max_retries=retries
+    )
+    session.mount('https://', adapter)
+    return session
+
+def load_portfolio_data(raw_df):
+    """Load and process the portfolio data from a sheet read without headers."""
     try:
-        # Read the Excel file without headers
-        df = pd.read_excel(file, header=None)
-        
-        # Find the row containing column headers (looking for 'Company Name')
-        header_row = None
-        for idx, row in df.iterrows():
-            if row.astype(str).str.contains('Company Name').any():
-                header_row = idx
-                break
+        df = raw_df
         
-        if header_row is None:
+        # Find the row containing column headers (looking for 'Company Name') with one
+        # comparison over the raw object array rather than a boolean DataFrame
+        header_mask = (df.to_numpy(dtype=object) == 'Company Name').any(axis=1)
+        if not header_mask.any():
             raise ValueError("Could not find column headers in the Excel file")
+        header_row = int(header_mask.argmax())
         
-        # Read the Excel file again with the correct header
-        df = pd.read_excel(file, header=header_row)
-        
-        # Clean up the data
-        df = df[df['Company Name'].notna()]  # Remove rows without company names
+        # Promote the header row to column names instead of re-reading the file,
+        # naming blank header cells the same way read_excel would
+        columns = [
+            col if pd.notna(col) else f"Unnamed: {i}"
+            for i, col in enumerate(df.iloc[header_row])
+        ]
+        df = df.iloc[header_row + 1:].reset_index(drop=True)
+        df.columns = columns
         
         # Convert numeric columns
         for col in ['Balance', 'Rate (Rs.)', 'Value (Rs.)']:
             if col in df.columns:
                 df[col] = pd.to_numeric(df[col], errors='coerce')
         
-        # Remove rows with NaN values in important columns
-        df = df.dropna(subset=['Company Name', 'Balance', 'Rate (Rs.)', 'Value (Rs.)'])
+        # Remove rows without a company name or with NaN values in important columns
+        required = ['Company Name', 'Balance', 'Rate (Rs.)', 'Value (Rs.)']
+        df = df.loc[df[required].notna().all(axis=1)].reset_index(drop=True)
+        
+        # Replace the object columns left by the header-less read with explicit dtypes
+        df = df.astype({col: dtype for col, dtype in HOLDING_DTYPES.items() if col in df.columns})
+        
+        # Share counts are usually whole numbers, so store them in the smallest integer type
+        # that fits (this is lossless; fractional units such as fund holdings stay float64)
+        df['Balance'] = pd.to_numeric(df['Balance'], downcast='integer')
         
         return df
     
@@ -48,59 +152,37 @@ def load_portfolio_data(file):
         st.error(f"Error in load_portfolio_data: {str(e)}")
         raise e
 
-def get_demat_info(file):
+def match_person_name(text):
+    """Return the person name from the first of NAME_PATTERNS that matches text."""
+    for pattern in NAME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return match.group(1).strip()
+    return None
+
+def get_demat_info(raw_df, filename):
     """Extract demat account information from filename or file content."""
-    if isinstance(file, str):
-        # If it's a file path, get the filename
-        filename = os.path.basename(file)
-        name = os.path.splitext(filename)[0]
-    else:
-        # If it's an uploaded file, get the filename
-        name = os.path.splitext(file.name)[0]
+    name = os.path.splitext(os.path.basename(filename))[0]
     
     # Default values
     dp_id = None
-    person_name = None
     
     # Try to extract person name from filename
-    # Common patterns: "name demat", "name's demat", etc.
-    name_patterns = [
-        r"^([A-Za-z\s]+)\s+demat",
-        r"^([A-Za-z\s]+)'s\s+demat",
-        r"^([A-Za-z\s]+)\s+portfolio"
-    ]
-    
-    for pattern in name_patterns:
-        match = re.search(pattern, name, re.IGNORECASE)
-        if match:
-            person_name = match.group(1).strip()
-            break
+    person_name = match_person_name(name)
     
     # If no name found in filename, try to extract from file content
     if not person_name:
-        try:
-            # Read the file to find name and DP ID
-            df = pd.read_excel(file, header=None)
-            for idx, row in df.iterrows():
-                for col in row:
-                    if isinstance(col, str):
-                        # Look for DP ID
-                        if 'DP ID' in col:
-                            dp_id = col.split(':')[1].strip()
-                        
-                        # Look for name patterns in the content
-                        for pattern in name_patterns:
-                            match = re.search(pattern, col, re.IGNORECASE)
-                            if match:
-                                person_name = match.group(1).strip()
-                                break
-                        
-                        if person_name:
-                            break
-                if person_name:
-                    break
-        except:
-            pass
+        # Text cells of the sheet's header region, in reading order
+        header_cells = raw_df.iloc[:DEMAT_INFO_SCAN_ROWS].to_numpy(dtype=object).ravel()
+        cells = [cell for cell in header_cells if isinstance(cell, str)]
+        
+        # Look for DP ID, stopping at the first cell that has one
+        dp_match = next(filter(None, map(DP_ID_PATTERN.search, cells)), None)
+        if dp_match:
+            dp_id = dp_match.group(1)
+        
+        # Look for name patterns in the content, stopping at the first matching cell
+        person_name = next(filter(None, map(match_person_name, cells)), None)
     
     # If still no name found, use the filename
     if not person_name:
@@ -115,132 +197,256 @@ def get_demat_info(file):
     
     return info
 
+# Browser-like headers; both Yahoo Finance and NSE reject the default requests client
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'application/json'
+}
+
+class PriceLookupError(Exception):
+    """A price lookup that found no price; raised rather than returned so failures are not cached."""
+
+# NSE index whose constituents are priced with a single bulk quote request
+NSE_BULK_INDEX = 'NIFTY 500'
+
+@st.cache_data(ttl=PRICE_CACHE_TTL, show_spinner=False)
+def fetch_index_prices(index=NSE_BULK_INDEX):
+    """Fetch last traded prices, keyed by ISIN, for every constituent of an NSE index.
+    
+    Raises on failure so that st.cache_data does not keep an empty result for the TTL.
+    """
+    session = get_http_session()
+    
+    # NSE only serves its API to clients holding the cookies set by the home page
+    session.get("https://www.nseindia.com", headers=REQUEST_HEADERS, timeout=10)
+    response = session.get(
+        "https://www.nseindia.com/api/equity-stockIndices",
+        params={'index': index},
+        headers=REQUEST_HEADERS,
+        timeout=10
+    )
+    if response.status_code != 200:
+        raise PriceLookupError(f"NSE quote for {index} failed. Status code: {response.status_code}")
+    
+    prices = {}
+    for quote in response.json().get('data', []):
+        isin = (quote.get('meta') or {}).get('isin')
+        if isin and quote.get('lastPrice'):
+            prices[isin] = float(quote['lastPrice'])
+    return prices
+
+def open_price_cache():
+    """Open the on-disk price cache, creating its table on first use."""
+    conn = sqlite3.connect(PRICE_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS prices (isin TEXT PRIMARY KEY, price REAL, fetched_at REAL)")
+    return conn
+
+def load_cached_prices(isins):
+    """Return the prices stored on disk within the last PRICE_CACHE_TTL seconds for the given ISINs."""
+    try:
+        with closing(open_price_cache()) as conn:
+            rows = conn.execute(
+                "SELECT isin, price FROM prices WHERE fetched_at >= ?",
+                (time.time() - PRICE_CACHE_TTL,)
+            ).fetchall()
+    except sqlite3.Error:
+        return {}
+    
+    wanted = set(isins)
+    return {isin: price for isin, price in rows if isin in wanted}
+
+def save_cached_prices(prices):
+    """Store freshly fetched prices on disk; failed lookups are never in the map, so they are retried."""
+    fetched_at = time.time()
+    rows = [(isin, float(price), fetched_at) for isin, price in prices.items()]
+    if not rows:
+        return
+    try:
+        # The inner "with conn" commits the inserts before the connection is closed
+        with closing(open_price_cache()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?)", rows)
+    except sqlite3.Error:
+        pass
+
+def fetch_prices_bulk(isins):
+    """Return the prices available from the NSE bulk quote for the given ISINs."""
+    if not isins:
+        return {}
+    try:
+        index_prices = fetch_index_prices()
+    except Exception:
+        # Leave every ISIN to the per-ISIN lookup; the failure is not cached, so the
+        # bulk quote is tried again on the next run
+        return {}
+    return {isin: index_prices[isin] for isin in isins if isin in index_prices}
+
+def fetch_ticker_price(ticker, session):
+    """Fetch the regular market price of a Yahoo Finance ticker from its chart metadata."""
+    # One small chart request carries the price; Ticker.info needs a cookie/crumb
+    # handshake plus a quoteSummary call for the same field
+    response = session.get(
+        f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}",
+        params={'range': '1d', 'interval': '1d'},
+        headers=REQUEST_HEADERS,
+        timeout=10
+    )
+    if response.status_code != 200:
+        return None
+    
+    results = (response.json().get('chart') or {}).get('result') or []
+    if not results:
+        return None
+    return results[0].get('meta', {}).get('regularMarketPrice')
+
+@st.cache_data(ttl=PRICE_CACHE_TTL, show_spinner=False)
 def fetch_current_price(isin):
-    """Fetch current market price for a given ISIN using Yahoo Finance."""
-    max_retries = 3
-    retry_delay = 2  # seconds
+    """Fetch current market price for a given ISIN using Yahoo Finance.
     
-    for attempt in range(max_retries):
-        try:
-            # First search for the ticker using Yahoo Finance search API
-            search_url = f"https://query2.finance.yahoo.com/v1/finance/search?q={isin}"
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'application/json'
-            }
-            
-            response = requests.get(search_url, headers=headers)
-            
-            if response.status_code == 429:  # Too Many Requests
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay * (attempt + 1))  # Exponential backoff
-                    continue
-                else:
-                    st.warning(f"Rate limited by Yahoo Finance for ISIN {isin}. Please try again later.")
-                    return None
-            
-            if response.status_code != 200:
-                st.warning(f"Failed to search for ISIN {isin}. Status code: {response.status_code}")
-                return None
-            
-            data = response.json()
-            quotes = data.get('quotes', [])
-            
-            if not quotes:
-                st.warning(f"No quotes found for ISIN {isin}")
-                return None
-            
-            # Look for NSE ticker in the search results
-            nse_ticker = None
-            for quote in quotes:
-                if quote.get('exchange') == 'NSI' and quote.get('symbol', '').endswith('.NS'):
-                    nse_ticker = quote.get('symbol')
-                    break
-            
-            if nse_ticker:
-                # Get the price using the found ticker
-                stock = yf.Ticker(nse_ticker)
-                current_price = stock.info.get('regularMarketPrice')
-                if current_price:
-                    return current_price
-            
-            # If NSE ticker not found or price not available, try BSE
-            for quote in quotes:
-                if quote.get('exchange') == 'BSE' and quote.get('symbol', '').endswith('.BO'):
-                    bse_ticker = quote.get('symbol')
-                    stock = yf.Ticker(bse_ticker)
-                    current_price = stock.info.get('regularMarketPrice')
-                    if current_price:
-                        return current_price
-            
-            st.warning(f"No price found for ISIN {isin} in either NSE or BSE")
-            return None
-            
-        except Exception as e:
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                st.warning(f"Error fetching price for ISIN {isin}: {str(e)}")
-                return None
+    Raises on failure instead of returning None, since st.cache_data only caches
+    return values; a failed lookup is therefore retried on the next run.
+    """
+    session = get_http_session()
     
-    return None
-
-def get_current_prices(df):
-    """Get current prices for all stocks in the dataframe using parallel processing."""
-    # Create a cache for prices to avoid duplicate API calls
-    price_cache = {}
+    # First search for the ticker using Yahoo Finance search API
+    search_url = f"https://query2.finance.yahoo.com/v1/finance/search?q={isin}"
+    response = session.get(search_url, headers=REQUEST_HEADERS, timeout=10)
+    
+    if response.status_code == 429:  # Too Many Requests, even after the session's retries
+        raise PriceLookupError(f"Rate limited by Yahoo Finance for ISIN {isin}. Please try again later.")
+    
+    if response.status_code != 200:
+        raise PriceLookupError(f"Failed to search for ISIN {isin}. Status code: {response.status_code}")
     
-    # Add a new column for current price
-    df['Current Price (Rs.)'] = None
+    data = response.json()
+    quotes = data.get('quotes', [])
     
+    if not quotes:
+        raise PriceLookupError(f"No quotes found for ISIN {isin}")
+    
+    # Look for NSE ticker in the search results
+    nse_ticker = None
+    for quote in quotes:
+        if quote.get('exchange') == 'NSI' and quote.get('symbol', '').endswith('.NS'):
+            nse_ticker = quote.get('symbol')
+            break
+    
+    if nse_ticker:
+        # Get the price using the found ticker
+        current_price = fetch_ticker_price(nse_ticker, session)
+        if current_price:
+            return current_price
+    
+    # If NSE ticker not found or price not available, try BSE
+    for quote in quotes:
+        if quote.get('exchange') == 'BSE' and quote.get('symbol', '').endswith('.BO'):
+            bse_ticker = quote.get('symbol')
+            current_price = fetch_ticker_price(bse_ticker, session)
+            if current_price:
+                return current_price
+    
+    raise PriceLookupError(f"No price found for ISIN {isin} in either NSE or BSE")
+
+def fetch_prices(unique_isins):
+    """Get current prices, keyed by ISIN, for the given distinct ISINs using parallel processing."""
     # Show a progress bar
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    # Get unique ISINs to avoid duplicate API calls
-    unique_isins = df['ISIN'].unique()
-    total_isins = len(unique_isins)
+    # Prices by ISIN, starting with the ones already cached on disk
+    price_cache = load_cached_prices(unique_isins)
+    uncached_isins = [isin for isin in unique_isins if isin not in price_cache]
+    
+    # Then everything one NSE bulk quote covers; the lookups themselves are cached across reruns
+    fetched_prices = fetch_prices_bulk(uncached_isins)
     
-    # Create a mapping of ISIN to row indices for faster updates
-    isin_to_rows = {isin: df[df['ISIN'] == isin].index.tolist() for isin in unique_isins}
+    # Only the ISINs outside the bulk quote need an individual lookup
+    remaining_isins = [isin for isin in uncached_isins if isin not in fetched_prices]
+    total_isins = len(remaining_isins)
     
-    # Process ISINs in parallel with reduced number of workers to avoid rate limiting
-    with ThreadPoolExecutor(max_workers=3) as executor:
+    # Process ISINs in parallel with reduced number of workers to avoid rate limiting.
+    # Workers get the script run context so the price cache works in them.
+    with ThreadPoolExecutor(max_workers=PRICE_FETCH_WORKERS, initializer=add_script_run_ctx,
+                            initargs=(None, get_script_run_ctx())) as executor:
         # Submit all tasks
-        future_to_isin = {executor.submit(fetch_current_price, isin): isin for isin in unique_isins}
+        future_to_isin = {executor.submit(fetch_current_price, isin): isin for isin in remaining_isins}
         
         # Process completed tasks
         completed = 0
         for future in as_completed(future_to_isin):
             isin = future_to_isin[future]
+            # Failed lookups are warned about here rather than inside the cached lookup,
+            # so they are neither cached nor re-shown on a cache hit
             try:
-                current_price = future.result()
-                # Update all rows with this ISIN
-                for row_idx in isin_to_rows[isin]:
-                    df.at[row_idx, 'Current Price (Rs.)'] = current_price
-                price_cache[isin] = current_price
+                fetched_prices[isin] = future.result()
+            except PriceLookupError as e:
+                st.warning(str(e))
             except Exception as e:
-                st.warning(f"Error fetching price for {isin}: {str(e)}")
+                st.warning(f"Error fetching price for ISIN {isin}: {str(e)}")
             
             # Update progress
             completed += 1
             progress_bar.progress(completed / total_isins)
             status_text.text(f"Processed {completed} of {total_isins} stocks")
-            
-            # Add a small delay between batches to avoid rate limiting
-            if completed % 5 == 0:  # Every 5 stocks
-                time.sleep(1)
     
     # Clear the progress indicators
     progress_bar.empty()
     status_text.empty()
     
-    # Calculate current value
-    df['Current Value (Rs.)'] = df['Balance'] * df['Current Price (Rs.)'].fillna(df['Rate (Rs.)'])
+    # Keep the new prices on disk for later runs and server restarts
+    save_cached_prices(fetched_prices)
+    price_cache.update(fetched_prices)
+    
+    return price_cache
+
+def add_current_prices(df, prices):
+    """Add current price and value columns to a demat's holdings from an ISIN -> price map."""
+    # Fill in the current price of every row with a single lookup by ISIN; ISINs whose
+    # lookup failed are missing, so cast to float64 (NaN) rather than leaving an object column
+    df['Current Price (Rs.)'] = df['ISIN'].map(prices).astype('float64')
+    
+    # Calculate current value, falling back to the statement rate where no price was found;
+    # done on the raw arrays to avoid building an intermediate filled Series
+    current_price = df['Current Price (Rs.)'].to_numpy()
+    rate = df['Rate (Rs.)'].to_numpy(dtype='float64')
+    df['Current Value (Rs.)'] = df['Balance'].to_numpy() * np.where(np.isnan(current_price), rate, current_price)
     
     return df
 
+def unify_categories(frames, columns):
+    """Give categorical columns the same categories in every frame so concat keeps them categorical."""
+    frames = list(frames)
+    for col in columns:
+        categories = union_categoricals([df[col] for df in frames]).categories
+        frames = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in frames]
+    return frames
+
+def build_consolidated(frames, include_current_prices):
+    """Combine the per-demat holdings and aggregate them by company."""
+    # Combine all dataframes, keeping the categorical columns categorical
+    frames = unify_categories(frames, ['Company Name', 'Scrip Type'])
+    consolidated_df = pd.concat(frames, ignore_index=True)
+    
+    # Define the aggregation dictionary based on whether current prices are available
+    agg_dict = {
+        'Balance': pd.NamedAgg('Balance', 'sum'),
+        'Rate (Rs.)': pd.NamedAgg('Rate (Rs.)', 'mean'),  # Use mean for rate
+        'Value (Rs.)': pd.NamedAgg('Value (Rs.)', 'sum'),
+        'Scrip Type': pd.NamedAgg('Scrip Type', 'first'),  # Take the first value
+        'ISIN': pd.NamedAgg('ISIN', 'first')  # Take the first value
+    }
+    
+    # Add current price columns to aggregation if they exist
+    if include_current_prices and 'Current Price (Rs.)' in consolidated_df.columns:
+        agg_dict.update({
+            'Current Price (Rs.)': pd.NamedAgg('Current Price (Rs.)', 'mean'),
+            'Current Value (Rs.)': pd.NamedAgg('Current Value (Rs.)', 'sum')
+        })
+    
+    # Group by Company Name (integer category codes) and aggregate; the display
+    # sorts by value itself, so the group keys are left unsorted
+    return (consolidated_df.groupby('Company Name', observed=True, sort=False)
+            .agg(**agg_dict).reset_index())
+
 def display_portfolio(df, title, tab_id, show_current_prices=False):
     """Display portfolio information for a given dataframe."""
     if df is None or len(df) == 0:
@@ -277,20 +483,23 @@ def display_portfolio(df, title, tab_id, show_current_prices=False):
     if show_current_prices and 'Current Price (Rs.)' in df.columns:
         display_cols.extend(['Current Price (Rs.)', 'Current Value (Rs.)'])
     
-    sortable_df = df[display_cols].copy()
-    sortable_df = sortable_df.sort_values('Value (Rs.)', ascending=False)
-    sortable_df = sortable_df.reset_index(drop=True)  # Reset the index
+    # Sort once (stable, so ties keep file order) for both the table and the top holdings
+    sorted_df = df.sort_values('Value (Rs.)', ascending=False, kind='mergesort')
+    sortable_df = sorted_df[display_cols].reset_index(drop=True)  # Reset the index
     
-    # Format the numeric columns
-    for col in ['Rate (Rs.)', 'Value (Rs.)', 'Current Price (Rs.)', 'Current Value (Rs.)']:
-        if col in sortable_df.columns:
-            sortable_df[col] = sortable_df[col].apply(lambda x: f"₹{x:,.2f}" if pd.notna(x) else "N/A")
+    # Format the numeric columns in the table itself so they stay numeric (and sortable)
+    currency_column = st.column_config.NumberColumn(format="₹%.2f")
+    column_config = {
+        col: currency_column
+        for col in ['Rate (Rs.)', 'Value (Rs.)', 'Current Price (Rs.)', 'Current Value (Rs.)']
+        if col in sortable_df.columns
+    }
     
-    st.dataframe(sortable_df, use_container_width=True)
+    st.dataframe(sortable_df, use_container_width=True, column_config=column_config)
     
     # Top Holdings Pie Chart
     st.subheader("Top 5 Holdings")
-    top_5 = df.nlargest(5, 'Value (Rs.)')
+    top_5 = sorted_df.head(5)
     fig_pie = px.pie(
         top_5,
         values='Value (Rs.)',
@@ -309,29 +518,32 @@ def display_portfolio(df, title, tab_id, show_current_prices=False):
     )
     st.plotly_chart(fig_hist, use_container_width=True, key=f"hist_{tab_id}")
 
+# Page styling; Streamlit rebuilds the page on every rerun, so it is re-sent each run
+CUSTOM_CSS = """
+    <style>
+    .main {
+        padding: 2rem;
+    }
+    .stPlotlyChart {
+        background-color: #ffffff;
+        border-radius: 5px;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+    }
+    .upload-text {
+        text-align: center;
+        padding: 2rem;
+        border: 2px dashed #ccc;
+        border-radius: 5px;
+        margin-bottom: 2rem;
+    }
+    </style>
+"""
+
 def main():
     st.set_page_config(page_title="Portfolio Dashboard", layout="wide")
     
     # Add custom CSS
-    st.markdown("""
-        <style>
-        .main {
-            padding: 2rem;
-        }
-        .stPlotlyChart {
-            background-color: #ffffff;
-            border-radius: 5px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .upload-text {
-            text-align: center;
-            padding: 2rem;
-            border: 2px dashed #ccc;
-            border-radius: 5px;
-            margin-bottom: 2rem;
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
     
     st.title("📊 Portfolio Dashboard")
     
@@ -379,12 +591,20 @@ def main():
         
         # Load data from each uploaded file
         for uploaded_file in uploaded_files:
-            info = get_demat_info(uploaded_file)
+            # Parse each workbook once (and only once per distinct upload across reruns)
+            # and share it between both helpers
+            try:
+                raw_df = read_workbook(uploaded_file.getvalue(), uploaded_file.name)
+            except Exception as e:
+                st.error(f"Error reading {uploaded_file.name}: {str(e)}")
+                continue
+            
+            info = get_demat_info(raw_df, uploaded_file.name)
             demat_name = info["display_name"]
             demat_info[demat_name] = info
             
             try:
-                df = load_portfolio_data(uploaded_file)
+                df = load_portfolio_data(raw_df)
                 demat_data[demat_name] = df
             except Exception as e:
                 st.error(f"Error loading {demat_name}: {str(e)}")
@@ -396,8 +616,13 @@ def main():
         # Fetch current prices if requested
         if show_current_prices:
             st.info("Fetching current market prices for all stocks...")
+            
+            # Look up each distinct ISIN once, even when it is held in several demats;
+            # rows without an ISIN cannot be looked up
+            all_isins = pd.concat([df['ISIN'] for df in demat_data.values()]).dropna().unique()
+            prices = fetch_prices(all_isins)
             for demat_name, df in demat_data.items():
-                demat_data[demat_name] = get_current_prices(df)
+                demat_data[demat_name] = add_current_prices(df, prices)
         
         # Create tabs for each demat and a consolidated tab
         tab_names = list(demat_data.keys()) + ["Consolidated"]
@@ -416,27 +641,8 @@ def main():
         with tabs[-1]:
             st.header("Consolidated Portfolio")
             
-            # Combine all dataframes
-            consolidated_df = pd.concat(demat_data.values(), ignore_index=True)
-            
-            # Define the aggregation dictionary based on whether current prices are available
-            agg_dict = {
-                'Balance': 'sum',
-                'Rate (Rs.)': 'mean',  # Use mean for rate
-                'Value (Rs.)': 'sum',
-                'Scrip Type': 'first',  # Take the first value
-                'ISIN': 'first'  # Take the first value
-            }
-            
-            # Add current price columns to aggregation if they exist
-            if show_current_prices and 'Current Price (Rs.)' in consolidated_df.columns:
-                agg_dict.update({
-                    'Current Price (Rs.)': 'mean',
-                    'Current Value (Rs.)': 'sum'
-                })
-            
-            # Group by Company Name and aggregate
-            consolidated_df = consolidated_df.groupby('Company Name').agg(agg_dict).reset_index()
+            # Combine all dataframes and aggregate by company
+            consolidated_df = build_consolidated(demat_data.values(), show_current_prices)
             
             # Display consolidated portfolio
             display_portfolio(consolidated_df, "Consolidated Portfolio", "consolidated", show_current_prices)